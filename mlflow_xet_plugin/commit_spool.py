@@ -0,0 +1,223 @@
+import os
+import json
+import time
+import fcntl
+import shutil
+import hashlib
+import uuid
+from contextlib import contextmanager
+from mlflow.exceptions import MlflowException
+
+# A batch that fails to commit on its own this many times is set aside in failed/
+MAX_BATCH_FAILURES = 3
+
+# Writers touch their staging directory at least this often while copying
+STAGING_HEARTBEAT_SECONDS = 60
+
+# Staging entries untouched for longer than this were left behind by a writer
+# that died mid-copy
+STALE_STAGING_SECONDS = 3600
+
+_COPY_CHUNK_SIZE = 16 * 1024 * 1024
+
+
+def write_files(fs, files):
+    """Write ``(local_file, dest_path)`` pairs to XetHub within the current transaction."""
+    for local_file, dest_path in files:
+        with open(local_file, 'rb') as src_file:
+            dest_file = fs.open(dest_path, 'wb')
+            dest_file.write(src_file.read())
+            dest_file.close()
+
+
+class CommitSpool:
+    """
+    Coordinates artifact writes from many processes logging to the same XetHub branch.
+
+    Instead of every process opening its own ``fs.transaction`` against the branch, each
+    process stages its files as a batch in a spool directory on storage shared by all of
+    them, then takes a lock file and commits every batch pending at that moment in a single
+    transaction. While one process is committing, the others keep staging, so the next lock
+    holder folds all of their batches into one combined commit. Batches writing to different
+    paths, e.g. different runs, never conflict; if two batches write the same path, the one
+    staged last wins. Staging order comes from each writer's wall clock, so last-writer-wins
+    across hosts only holds if their clocks are synchronised.
+
+    If a combined commit fails, the lock holder bisects the pending batches until each bad
+    batch is isolated, committing the good ones together along the way. A batch that fails on
+    its own is dropped if it belongs to the lock holder, and otherwise moved to ``failed/``
+    after failing ``MAX_BATCH_FAILURES`` times, as are batches whose manifest can't be read.
+
+    Writers stage outside the lock and keep their staging directory's mtime fresh while
+    copying, so that only staging left behind by dead writers is swept.
+
+    The lock uses ``flock``, so the spool directory must live on a filesystem that supports
+    it (local disk, or NFS on Linux).
+    """
+
+    def __init__(self, spool_dir, branch_uri, xet_client):
+        # one spool per branch, as that is the unit a transaction commits to
+        key = hashlib.sha1(branch_uri.encode("utf-8")).hexdigest()
+        self.root = os.path.join(spool_dir, key)
+        self.pending_dir = os.path.join(self.root, "pending")
+        self.staging_dir = os.path.join(self.root, "staging")
+        self.failed_dir = os.path.join(self.root, "failed")
+        self.lock_path = os.path.join(self.root, "commit.lock")
+        self.xet_client = xet_client
+        os.makedirs(self.pending_dir, exist_ok=True)
+        os.makedirs(self.staging_dir, exist_ok=True)
+        os.makedirs(self.failed_dir, exist_ok=True)
+
+    @contextmanager
+    def lock(self):
+        """Hold the spool's commit lock, blocking until it is available."""
+        with open(self.lock_path, "a+") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def stage(self, files, commit_msg):
+        """
+        Copy files into a new pending batch and return the batch name.
+
+        :param files: List of ``(local_file, dest_path)`` pairs, where dest_path is a full
+                      xet:// path on the spool's branch.
+        :param commit_msg: Commit message describing the batch.
+        """
+        # names sort in staging order, so later batches override earlier ones
+        name = "%020d-%d-%s" % (time.time_ns(), os.getpid(), uuid.uuid4().hex)
+        staging_path = os.path.join(self.staging_dir, name)
+        os.makedirs(staging_path)
+        manifest = {"message": commit_msg, "files": []}
+        for i, (local_file, dest_path) in enumerate(files):
+            self._copy_with_heartbeat(local_file, os.path.join(staging_path, str(i)), staging_path)
+            manifest["files"].append({"src": str(i), "dest": dest_path})
+        with open(os.path.join(staging_path, "manifest.json"), "w") as f:
+            json.dump(manifest, f)
+
+        # publish the batch atomically so a committer never sees it half written
+        os.rename(staging_path, os.path.join(self.pending_dir, name))
+        return name
+
+    def commit(self, batch):
+        """
+        Make sure ``batch`` is committed to XetHub, committing it together with every other
+        pending batch unless another process already did so while we waited for the lock.
+        """
+        with self.lock():
+            self._sweep_staging()
+            batch_path = os.path.join(self.pending_dir, batch)
+            batches = self._load_pending()
+            if not os.path.exists(batch_path):
+                if os.path.exists(os.path.join(self.failed_dir, batch)):
+                    raise MlflowException(
+                        "Artifact batch {batch} could not be committed and was moved to"
+                        " {failed_dir}.".format(batch=batch, failed_dir=self.failed_dir))
+                return
+
+            own_error = None
+            failed = self._commit_isolating(batches)
+            # when everything failed, the problem isn't any one batch, so don't penalise others
+            blame_others = len(failed) < len(batches)
+            for path, error in failed:
+                if path == batch_path:
+                    # our own batch is bad; drop it so the caller's failure is final
+                    shutil.rmtree(batch_path, ignore_errors=True)
+                    own_error = error
+                elif blame_others:
+                    self._record_failure(path)
+            if own_error is not None:
+                raise own_error
+
+    def _commit_isolating(self, batches):
+        """
+        Commit batches in staging order, bisecting on failure so that good batches still go in
+        together. Committed batches are removed from the spool. Returns ``(batch_path, error)``
+        for each batch that failed to commit on its own.
+        """
+        try:
+            self._commit_batches(batches)
+        except Exception as e:
+            if len(batches) == 1:
+                return [(batches[0][0], e)]
+            middle = len(batches) // 2
+            return self._commit_isolating(batches[:middle]) + self._commit_isolating(batches[middle:])
+        for path, _ in batches:
+            shutil.rmtree(path, ignore_errors=True)
+        return []
+
+    def _load_pending(self):
+        batches = []
+        for name in sorted(os.listdir(self.pending_dir)):
+            batch_path = os.path.join(self.pending_dir, name)
+            try:
+                with open(os.path.join(batch_path, "manifest.json")) as f:
+                    batches.append((batch_path, json.load(f)))
+            except (OSError, ValueError):
+                self._move_to_failed(batch_path)
+        return batches
+
+    def _commit_batches(self, batches):
+        writes = {}
+        for batch_path, manifest in batches:
+            for entry in manifest["files"]:
+                writes[entry["dest"]] = os.path.join(batch_path, entry["src"])
+
+        if len(batches) == 1:
+            commit_msg = batches[0][1]["message"]
+        else:
+            commit_msg = "Log artifacts from %d batches\n\n%s" % (
+                len(batches), "\n".join(manifest["message"] for _, manifest in batches))
+
+        fs = self.xet_client.XetFS()
+        with fs.transaction as tr:
+            tr.set_commit_message(commit_msg)
+            write_files(fs, [(src_path, dest_path) for dest_path, src_path in writes.items()])
+
+    def _record_failure(self, batch_path):
+        failures_path = os.path.join(batch_path, "failures")
+        try:
+            with open(failures_path) as f:
+                failures = int(f.read())
+        except (OSError, ValueError):
+            failures = 0
+        failures += 1
+        if failures >= MAX_BATCH_FAILURES:
+            self._move_to_failed(batch_path)
+            return
+        with open(failures_path, "w") as f:
+            f.write(str(failures))
+
+    def _move_to_failed(self, batch_path):
+        try:
+            os.rename(batch_path, os.path.join(self.failed_dir, os.path.basename(batch_path)))
+        except OSError:
+            shutil.rmtree(batch_path, ignore_errors=True)
+
+    @staticmethod
+    def _copy_with_heartbeat(src_path, dst_path, staging_path):
+        # a single large copy doesn't update the staging directory's mtime, so touch it
+        # periodically to keep _sweep_staging from taking it for abandoned
+        last_beat = time.monotonic()
+        with open(src_path, 'rb') as src_file, open(dst_path, 'wb') as dst_file:
+            while True:
+                chunk = src_file.read(_COPY_CHUNK_SIZE)
+                if not chunk:
+                    break
+                dst_file.write(chunk)
+                if time.monotonic() - last_beat >= STAGING_HEARTBEAT_SECONDS:
+                    os.utime(staging_path)
+                    last_beat = time.monotonic()
+
+    def _sweep_staging(self):
+        # live writers touch their staging directory at least every STAGING_HEARTBEAT_SECONDS
+        cutoff = time.time() - STALE_STAGING_SECONDS
+        for name in os.listdir(self.staging_dir):
+            staging_path = os.path.join(self.staging_dir, name)
+            try:
+                if os.path.getmtime(staging_path) < cutoff:
+                    shutil.rmtree(staging_path, ignore_errors=True)
+            except OSError:
+                continue
@@ -1,11 +1,85 @@
 import os
+import re
 import sys
+import time
+import uuid
+import shutil
+import hashlib
+import functools
+import threading
 import pyxet
 import posixpath
+from collections import OrderedDict
+from contextlib import nullcontext
 from mlflow.exceptions import MlflowException
 from mlflow.entities import FileInfo
 from mlflow.utils.file_utils import relative_path_to_artifact_path
 from mlflow.store.artifact.artifact_repo import ArtifactRepository
+from mlflow_xet_plugin.commit_spool import CommitSpool, write_files
+
+# Content at a commit never changes, so anything read through a commit-pinned
+# uri can be cached in memory (listings) or on disk indefinitely (downloaded
+# files), without revalidation.
+_COMMIT_RE = re.compile(r"^[0-9a-f]{40}$")
+
+# Listings at pinned commits, least recently used first. Bounded because every
+# write to a branch moves its head and makes a new set of listings reachable.
+_LISTING_CACHE_SIZE = 1024
+_pinned_listing_cache = OrderedDict()
+
+# (user, repo, branch) -> (commit, resolved_at), shared by every repository in
+# the process so that repeated loads don't resolve the branch again. Off by
+# default; entries live for MLFLOW_XET_BRANCH_TTL seconds, or until this
+# process writes to the branch.
+_branch_commit_cache = {}
+_cache_lock = threading.Lock()
+
+
+def _artifact_cache_dir():
+    return os.environ.get("MLFLOW_XET_CACHE_DIR",
+                          os.path.join(os.path.expanduser("~"), ".cache", "mlflow-xethub"))
+
+
+def _branch_commit_ttl():
+    return _parse_branch_commit_ttl(os.environ.get("MLFLOW_XET_BRANCH_TTL", "0"))
+
+
+@functools.lru_cache(maxsize=None)
+def _parse_branch_commit_ttl(value):
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        print(f"Ignoring invalid MLFLOW_XET_BRANCH_TTL {value!r}, branch resolutions won't be shared")
+        return 0.0
+
+
+def _get_cached_listing(path):
+    with _cache_lock:
+        infos = _pinned_listing_cache.get(path)
+        if infos is not None:
+            _pinned_listing_cache.move_to_end(path)
+        return infos
+
+
+def _cache_listing(path, infos):
+    with _cache_lock:
+        _pinned_listing_cache[path] = infos
+        _pinned_listing_cache.move_to_end(path)
+        while len(_pinned_listing_cache) > _LISTING_CACHE_SIZE:
+            _pinned_listing_cache.popitem(last=False)
+
+
+def _copy_out(src_path, dst_path):
+    # copy a cached file or directory to a private location, so callers can't modify the cache
+    if os.path.isdir(src_path):
+        for (root, _, filenames) in os.walk(src_path):
+            target_dir = os.path.normpath(os.path.join(dst_path, os.path.relpath(root, src_path)))
+            os.makedirs(target_dir, exist_ok=True)
+            for f in filenames:
+                shutil.copyfile(os.path.join(root, f), os.path.join(target_dir, f))
+    else:
+        os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+        shutil.copyfile(src_path, dst_path)
 
 
 class XetHubArtifactRepository(ArtifactRepository):
@@ -18,9 +92,13 @@ class XetHubArtifactRepository(ArtifactRepository):
 
         super(XetHubArtifactRepository, self).__init__(artifact_uri)
 
+        # commit-pinned uri used for reads, resolved lazily from the branch
+        self._read_uri = None
+
         # Allow override for testing
         if xet_client:
             self.xet_client = xet_client
+            self._spool = self._make_spool()
             return
         
         self.xet_client = pyxet
@@ -28,12 +106,37 @@ class XetHubArtifactRepository(ArtifactRepository):
         # strip trailing slash as posix join will add slash in between paths
         if artifact_uri.endswith("/"):
             self.artifact_uri = artifact_uri[:-1]
+        self._spool = self._make_spool()
 
         # pathComponents = self.artifact_uri.split("/")
         # if len(pathComponents) < 8:
         #     raise Exception("Invalid artifact URI format, check if the artifact destination/root passed to your MLflow server is of the form xet://user/repo/branch")
     
 
+    def _make_spool(self):
+        # Coordinated commit mode: with MLFLOW_XET_SPOOL_DIR pointing at storage shared by
+        # all writers, writes to the same branch are staged and merged into combined commits
+        spool_dir = os.environ.get("MLFLOW_XET_SPOOL_DIR")
+        key = self._branch_key()
+        if not spool_dir or key is None:
+            return None
+        return CommitSpool(spool_dir, "xet://" + "/".join(key), self.xet_client)
+
+    def _commit_files(self, files, commit_msg):
+        """
+        Write ``(local_file, dest_path)`` pairs to XetHub in one commit, or through the commit
+        spool when coordinated commit mode is enabled.
+        """
+        if self._spool:
+            batch = self._spool.stage(files, commit_msg)
+            self._spool.commit(batch)
+        else:
+            fs = self.xet_client.XetFS()
+            with fs.transaction as tr:
+                tr.set_commit_message(commit_msg)
+                write_files(fs, files)
+        self._invalidate_read_uri()
+
     """
         Log a local file as an artifact, optionally taking an ``artifact_path`` to place it in
         within the run's artifacts. Run artifacts can be organized into directories, so you can
@@ -52,16 +155,10 @@ class XetHubArtifactRepository(ArtifactRepository):
             dest_path = posixpath.join(self.artifact_uri, os.path.basename(local_file))
             
         # Store file to XetHub
-        fs = self.xet_client.XetFS()
         commit_msg = "Log artifact %s" % os.path.basename(local_file)
 
         sys.stdout.write(f"Logging artifact to XetHub from {local_file} to {dest_path}\n")
-        with fs.transaction as tr:
-            tr.set_commit_message(commit_msg)
-            dest_file = fs.open(dest_path, 'wb')
-            src_file = open(local_file, 'rb').read()
-            dest_file.write(src_file)
-            dest_file.close()
+        self._commit_files([(local_file, dest_path)], commit_msg)
 
         sys.stdout.write(f"Logged artifact to XetHub from {local_file} to {dest_path}\n")
 
@@ -79,27 +176,23 @@ class XetHubArtifactRepository(ArtifactRepository):
         if artifact_path:
             dest_path = posixpath.join(dest_path, artifact_path)
 
-        fs = self.xet_client.XetFS()
         local_dir = os.path.abspath(local_dir)
         commit_msg = "Log artifacts under %s" % os.path.basename(local_dir)
 
         sys.stdout.write(f"Logging artifacts to XetHub from {local_dir} to {dest_path}\n")
-        with fs.transaction as tr:
-            tr.set_commit_message(commit_msg)
-            for (root, _, filenames) in os.walk(local_dir):
-                upload_path = dest_path
-                if root != local_dir:
-                    rel_path = os.path.relpath(root, local_dir)
-                    rel_path = relative_path_to_artifact_path(rel_path)
-                    upload_path = posixpath.join(dest_path, rel_path)
-                for f in filenames:
-                    local_file = posixpath.join(root, f)
-                    file_dest_path = posixpath.join(upload_path, f)
-                    dest_file = fs.open(file_dest_path, 'wb')
-                    src_file = open(local_file, 'rb').read()
-                    dest_file.write(src_file)
-                    dest_file.close()
-                
+        files = []
+        for (root, _, filenames) in os.walk(local_dir):
+            upload_path = dest_path
+            if root != local_dir:
+                rel_path = os.path.relpath(root, local_dir)
+                rel_path = relative_path_to_artifact_path(rel_path)
+                upload_path = posixpath.join(dest_path, rel_path)
+            for f in filenames:
+                local_file = posixpath.join(root, f)
+                file_dest_path = posixpath.join(upload_path, f)
+                files.append((local_file, file_dest_path))
+        self._commit_files(files, commit_msg)
+
         sys.stdout.write(f"Logged artifacts to XetHub from {local_dir} to {dest_path}\n")
 
     """
@@ -111,19 +204,24 @@ class XetHubArtifactRepository(ArtifactRepository):
         :return: List of artifacts as FileInfo listed directly under path.
     """
     def list_artifacts(self, path=None):
-        artifact_path = self.artifact_uri
+        artifact_path, pinned = self._get_read_uri()
         
         dest_path = artifact_path
         if path:
             dest_path = posixpath.join(dest_path, path)
 
+        if pinned:
+            cached_infos = _get_cached_listing(dest_path)
+            if cached_infos is not None:
+                return list(cached_infos)
+
         print("Listing artifacts of %s\n" % dest_path)
 
         infos = []
-        dest_path = dest_path + "/" if dest_path else ""
+        list_path = dest_path + "/" if dest_path else ""
         fs = self.xet_client.XetFS()
-        if fs.isdir(dest_path):
-            entries = fs.ls(dest_path)
+        if fs.isdir(list_path):
+            entries = fs.ls(list_path)
 
             for entry in entries:
                 entryName = entry["name"]
@@ -150,7 +248,111 @@ class XetHubArtifactRepository(ArtifactRepository):
             pass
 
         print(f"Listed artifacts: {infos}")
-        return sorted(infos, key=lambda f: f.path)
+        infos = sorted(infos, key=lambda f: f.path)
+        if pinned:
+            _cache_listing(dest_path, infos)
+        return list(infos)
+
+    def _get_read_uri(self):
+        """
+        Return ``(uri, pinned)``: the artifact uri with its branch replaced by the commit the
+        branch points to, and whether reads through it are pinned to a commit. A uri that already
+        names a commit is pinned as is. Otherwise the branch is resolved once per repository, and
+        again only after this repository writes, so all reads in between see one immutable
+        snapshot of the run. Falls back to the unpinned branch uri if the commit cannot be
+        resolved, and tries again on the next read.
+        """
+        read_uri = self._read_uri
+        if read_uri is None:
+            read_uri, pinned = self._resolve_commit_uri()
+            if not pinned:
+                return read_uri, False
+            self._read_uri = read_uri
+        return read_uri, True
+
+    def _branch_key(self):
+        # artifact_uri is of the format xet://user/repo/branch/mlflow_experiment_group/mlflow_run_id/artifacts
+        if not self.artifact_uri.startswith("xet://"):
+            return None
+        components = self.artifact_uri[len("xet://"):].split("/", 3)
+        if len(components) < 3:
+            return None
+        return tuple(components[:3])
+
+    def _resolve_commit_uri(self):
+        key = self._branch_key()
+        if key is None:
+            return self.artifact_uri, False
+        user, repo, ref = key
+        if _COMMIT_RE.match(ref):
+            # already pinned
+            return self.artifact_uri, True
+
+        ttl = _branch_commit_ttl()
+        with _cache_lock:
+            cached = _branch_commit_cache.get(key)
+        if ttl and cached and time.monotonic() - cached[1] < ttl:
+            commit = cached[0]
+        else:
+            try:
+                fs = self.xet_client.XetFS()
+                commit = fs.branch_info(f"xet://{user}/{repo}", ref)["id"]
+            except Exception as e:
+                print(f"Could not resolve commit of branch {ref}, reading from the branch: {e}")
+                return self.artifact_uri, False
+            if ttl:
+                with _cache_lock:
+                    _branch_commit_cache[key] = (commit, time.monotonic())
+
+        components = self.artifact_uri[len("xet://"):].split("/", 3)
+        components[2] = commit
+        return "xet://" + "/".join(components), True
+
+    def _invalidate_read_uri(self):
+        # our own writes move the branch, so the next read must resolve it again
+        self._read_uri = None
+        key = self._branch_key()
+        if key is not None:
+            with _cache_lock:
+                _branch_commit_cache.pop(key, None)
+
+    def _cached_artifact_path(self, remote_path):
+        # remote_path is of the format xet://user/repo/commit/path. Entries are keyed flat by a
+        # hash of the path under the commit, so a cached file never creates the directory a
+        # later download of its parent would find, and an entry exists only once complete.
+        user, repo, commit, path = (remote_path[len("xet://"):].rstrip("/") + "/").split("/", 3)
+        key = hashlib.sha1(path.rstrip("/").encode("utf-8")).hexdigest()
+        return os.path.join(_artifact_cache_dir(), user, repo, commit, key)
+
+    def _fetch_pinned(self, remote_path, recursive=False):
+        """
+        Download a path at a pinned commit into the local artifact cache, unless it is already
+        there, and return its local location. The download goes to a temporary location first
+        so that a partially fetched artifact never appears in the cache.
+        """
+        cached_path = self._cached_artifact_path(remote_path)
+        if os.path.exists(cached_path):
+            return cached_path
+
+        os.makedirs(os.path.dirname(cached_path), exist_ok=True)
+        tmp_path = f"{cached_path}.{uuid.uuid4().hex}.tmp"
+        fs = self.xet_client.XetFS()
+        print(f"Downloading artifacts from {remote_path} to {cached_path}\n")
+        try:
+            fs.get(remote_path, tmp_path, recursive=recursive)
+            try:
+                os.replace(tmp_path, cached_path)
+            except OSError:
+                # another process populated the cache first
+                if not os.path.exists(cached_path):
+                    raise
+        finally:
+            if os.path.isdir(tmp_path):
+                shutil.rmtree(tmp_path, ignore_errors=True)
+            elif os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        print(f"Downloaded artifacts from {remote_path} to {cached_path}")
+        return cached_path
 
     @staticmethod
     def _verify_listed_entry_contains_artifact_path_prefix(listed_entry_path, artifact_path):
@@ -163,14 +365,16 @@ class XetHubArtifactRepository(ArtifactRepository):
 
     def download_artifacts(self, artifact_path, dst_path=None):
         """
-        Artifacts tracked by the plugin already exist on the local filesystem.
-        If ``dst_path`` is ``None``, the absolute filesystem path of the specified artifact is
-        returned. If ``dst_path`` is not ``None``, the local artifact is copied to ``dst_path``.
+        Download an artifact file or directory from XetHub to a local directory.
+        If ``dst_path`` is ``None``, the artifacts are downloaded under ``./mlruns`` at the
+        same experiment and run subpath they have on XetHub. When reads are pinned to a commit,
+        the content is served from the local artifact cache and copied out, so that callers
+        never get a path inside the shared cache.
 
         :param artifact_path: Relative source path to the desired artifacts.
         :param dst_path: Absolute path of the local filesystem destination directory to which to
                          download the specified artifacts. This directory must already exist. If
-                         unspecified, the absolute path of the local artifact will be returned.
+                         unspecified, the artifacts are downloaded under ``./mlruns``.
 
         :return: Absolute path of the local filesystem location containing the desired artifacts.
         """
@@ -180,12 +384,22 @@ class XetHubArtifactRepository(ArtifactRepository):
         # NOTE: The artifact_path is expected to be in posix format.        
         else:
             rel_artifact_path = artifact_path
-            artifact_path = posixpath.join(self.artifact_uri, artifact_path)
+            read_uri, pinned = self._get_read_uri()
+            artifact_path = posixpath.join(read_uri, artifact_path)
 
             # artifact_path is of the format xet://user/repo/branch/mlflow_experiment_group/mlflow_run_id/artifacts/file
             mlflow_subpath = "/".join(artifact_path.split("/")[5:])
             dst_path = os.path.abspath("./mlruns/"+mlflow_subpath)
 
+            if pinned:
+                # content at a commit is immutable, so a cached copy is always valid
+                cached_path = self._cached_artifact_path(artifact_path)
+                if not os.path.exists(cached_path):
+                    fs = self.xet_client.XetFS()
+                    cached_path = self._fetch_pinned(artifact_path, recursive=fs.isdir(artifact_path))
+                _copy_out(cached_path, dst_path)
+                return dst_path
+
             fs = self.xet_client.XetFS()
             if fs.isdir(artifact_path):
                 print(f"Downloading artifacts from {artifact_path} to {dst_path}\n")
@@ -197,15 +411,25 @@ class XetHubArtifactRepository(ArtifactRepository):
             return dst_path
 
     def _download_file(self, remote_file_path, local_path):
-        fs = self.xet_client.XetFS()
-        xet_root_path = self.artifact_uri
+        xet_root_path, pinned = self._get_read_uri()
         xet_full_path = posixpath.join(xet_root_path, remote_file_path)
+        if pinned:
+            cached_path = self._fetch_pinned(xet_full_path)
+            shutil.copyfile(cached_path, local_path)
+            return
+        fs = self.xet_client.XetFS()
         print(f"Downloading artifact from {xet_full_path} to {local_path}\n")
         fs.get(xet_full_path, local_path)
         print(f"Downloaded artifact from {xet_full_path} to {local_path}\n")
 
     def delete_artifacts(self, artifact_path=None):
+        # in coordinated commit mode, don't race the spool's combined commits
+        with self._spool.lock() if self._spool else nullcontext():
+            self._delete_artifacts(artifact_path)
+
+    def _delete_artifacts(self, artifact_path):
         fs = self.xet_client.XetFS()
+        self._invalidate_read_uri()
         if fs.isdir(artifact_path):
             commit_msg = "Delete artifacts in %s" % os.path.basename(artifact_path)
             print("Deleting artifacts from %s\n" % (artifact_path))
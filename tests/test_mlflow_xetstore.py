@@ -10,6 +10,9 @@ import pytest
 from mlflow.utils.file_utils import TempDir
 from mlflow.store.artifact.artifact_repository_registry import get_artifact_repository
 from mlflow_xet_plugin.xet_artifact import XetHubArtifactRepository
+from mlflow_xet_plugin import commit_spool
+from mlflow_xet_plugin.commit_spool import CommitSpool, MAX_BATCH_FAILURES, STALE_STAGING_SECONDS
+from mlflow.exceptions import MlflowException
 from mlflow import log_artifact, log_artifacts, get_artifact_uri, create_experiment, set_experiment, MlflowClient, pyfunc
 
 from mlflow.entities import (Experiment, Run, RunInfo, RunData, RunTag, Metric,
@@ -269,6 +272,302 @@ def test_artifact_download_artifacts_idempotent(run):
     test_artifact_download_artifacts(run)
     test_artifact_download_artifacts(run)
 
+def test_list_artifacts_pinned_to_commit(run):
+    artifact_uri = run.info.artifact_uri
+    repository = get_artifact_repository(artifact_uri)
+    artifacts = repository.list_artifacts()
+    assert(artifacts)
+    read_uri, pinned = repository._get_read_uri()
+    assert(pinned)
+    assert(read_uri != repository.artifact_uri)
+
+    # listings at a pinned commit are served without touching XetHub again
+    with mock.patch.object(pyxet, "XetFS") as xetfs_mock:
+        assert(repository.list_artifacts() == artifacts)
+        xetfs_mock.assert_not_called()
+
+def test_log_artifact_repins_reads(run):
+    artifact_uri = run.info.artifact_uri
+    repository = get_artifact_repository(artifact_uri)
+    read_uri, _ = repository._get_read_uri()
+    with open("repin.txt", "w") as f:
+        f.write("repin")
+    repository.log_artifact("repin.txt")
+    assert(repository._get_read_uri()[0] != read_uri)
+    assert("repin.txt" in [a.path for a in repository.list_artifacts()])
+
+def test_download_artifacts_pinned_is_cached(run, tmp_path, monkeypatch):
+    monkeypatch.setenv("MLFLOW_XET_CACHE_DIR", str(tmp_path))
+    artifact_uri = run.info.artifact_uri
+    repository = get_artifact_repository(artifact_uri)
+    local_path = repository.download_artifacts("hello.txt")
+    # callers get a private copy, not a path inside the shared cache
+    assert(not local_path.startswith(str(tmp_path)))
+    assert(os.listdir(tmp_path))
+    with open(local_path) as f:
+        assert(f.read() == "world!")
+
+    with mock.patch.object(pyxet, "XetFS") as xetfs_mock:
+        assert(repository.download_artifacts("hello.txt") == local_path)
+        xetfs_mock.assert_not_called()
+
+def test_explicit_commit_uri_is_cached(tmp_path, monkeypatch):
+    monkeypatch.setenv("MLFLOW_XET_CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.chdir(tmp_path)
+    commit = "0123456789abcdef0123456789abcdef01234567"
+    artifact_uri = f"xet://user/repo/{commit}/0/run/artifacts"
+
+    xet_client = mock.MagicMock()
+    fs = xet_client.XetFS.return_value
+    fs.isdir.side_effect = lambda path: not path.endswith(".txt")
+    fs.ls.return_value = [{"name": f"user/repo/{commit}/0/run/artifacts/a.txt", "type": "file", "size": 5}]
+    def get(remote_path, local_path, recursive=False):
+        with open(local_path, "w") as f:
+            f.write("hello")
+    fs.get.side_effect = get
+
+    repository = XetHubArtifactRepository(artifact_uri, xet_client=xet_client)
+    assert([a.path for a in repository.list_artifacts()] == ["a.txt"])
+    assert([a.path for a in repository.list_artifacts()] == ["a.txt"])
+    assert(fs.ls.call_count == 1)
+    fs.branch_info.assert_not_called()
+
+    local_path = repository.download_artifacts("a.txt")
+    assert(local_path == os.path.abspath("mlruns/0/run/artifacts/a.txt"))
+    with open(local_path) as f:
+        assert(f.read() == "hello")
+
+    # a new repository for the same commit is served from the cache
+    os.remove(local_path)
+    repository = XetHubArtifactRepository(artifact_uri, xet_client=xet_client)
+    assert(repository.download_artifacts("a.txt") == local_path)
+    assert(fs.get.call_count == 1)
+    assert([a.path for a in repository.list_artifacts()] == ["a.txt"])
+    assert(fs.ls.call_count == 1)
+
+def test_pinned_file_then_parent_directory_download(tmp_path, monkeypatch):
+    monkeypatch.setenv("MLFLOW_XET_CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.chdir(tmp_path)
+    commit = "fedcba9876543210fedcba9876543210fedcba98"
+    artifact_uri = f"xet://user/repo/{commit}/0/run/artifacts"
+
+    xet_client = mock.MagicMock()
+    fs = xet_client.XetFS.return_value
+    fs.isdir.side_effect = lambda path: path.rstrip("/").endswith("/model")
+    def get(remote_path, local_path, recursive=False):
+        if recursive:
+            os.makedirs(local_path)
+            for name in ["MLmodel", "model.pkl"]:
+                with open(os.path.join(local_path, name), "w") as f:
+                    f.write(name)
+        else:
+            with open(local_path, "w") as f:
+                f.write(posixpath.basename(remote_path))
+    fs.get.side_effect = get
+
+    # the way MLflow loads a model: read MLmodel, then fetch the whole directory
+    repository = XetHubArtifactRepository(artifact_uri, xet_client=xet_client)
+    repository.download_artifacts("model/MLmodel")
+    local_path = repository.download_artifacts("model")
+    assert(sorted(os.listdir(local_path)) == ["MLmodel", "model.pkl"])
+    assert(fs.get.call_count == 2)
+
+def test_branch_resolution_shared_when_enabled_and_failures_retried(monkeypatch):
+    monkeypatch.setenv("MLFLOW_XET_BRANCH_TTL", "60")
+    commit = "89abcdef0123456789abcdef0123456789abcdef"
+    artifact_uri = "xet://user/repo/retry-branch/0/run/artifacts"
+    pinned_uri = f"xet://user/repo/{commit}/0/run/artifacts"
+
+    xet_client = mock.MagicMock()
+    fs = xet_client.XetFS.return_value
+    fs.branch_info.side_effect = [Exception("unavailable"), {"id": commit}]
+
+    repository = XetHubArtifactRepository(artifact_uri, xet_client=xet_client)
+    assert(repository._get_read_uri() == (artifact_uri, False))
+    # the fallback is not kept, so the next read resolves again
+    assert(repository._get_read_uri() == (pinned_uri, True))
+
+    # other repositories in the process reuse the resolved commit
+    other = XetHubArtifactRepository(artifact_uri, xet_client=xet_client)
+    assert(other._get_read_uri() == (pinned_uri, True))
+    assert(fs.branch_info.call_count == 2)
+
+def test_branch_resolution_per_repository_by_default(monkeypatch):
+    monkeypatch.setenv("MLFLOW_XET_BRANCH_TTL", "not-a-number")
+    artifact_uri = "xet://user/repo/default-branch/0/run/artifacts"
+
+    xet_client = mock.MagicMock()
+    fs = xet_client.XetFS.return_value
+    fs.branch_info.side_effect = [{"id": "1" * 40}, {"id": "2" * 40}]
+
+    repository = XetHubArtifactRepository(artifact_uri, xet_client=xet_client)
+    assert(repository._get_read_uri() == (f"xet://user/repo/{'1' * 40}/0/run/artifacts", True))
+    assert(repository._get_read_uri() == (f"xet://user/repo/{'1' * 40}/0/run/artifacts", True))
+    # a new repository sees commits made by other processes since
+    other = XetHubArtifactRepository(artifact_uri, xet_client=xet_client)
+    assert(other._get_read_uri() == (f"xet://user/repo/{'2' * 40}/0/run/artifacts", True))
+
+def test_log_artifact_coordinated_commit(run, tmp_path, monkeypatch):
+    monkeypatch.setenv("MLFLOW_XET_SPOOL_DIR", str(tmp_path / "spool"))
+    artifact_uri = run.info.artifact_uri
+    repository = get_artifact_repository(artifact_uri)
+    assert(repository._spool)
+    with open("spooled.txt", "w") as f:
+        f.write("spooled")
+    repository.log_artifact("spooled.txt")
+    # the batch was committed and removed from the spool
+    assert(not os.listdir(repository._spool.pending_dir))
+    assert("spooled.txt" in [a.path for a in repository.list_artifacts()])
+
+def test_coordinated_commit_merges_pending_batches(tmp_path):
+    files = []
+    for i in range(3):
+        local_file = tmp_path / f"file{i}.txt"
+        local_file.write_text(str(i))
+        files.append(str(local_file))
+
+    xet_client = mock.MagicMock()
+    fs = xet_client.XetFS.return_value
+    spool = CommitSpool(str(tmp_path / "spool"), "xet://user/repo/main", xet_client)
+    batches = [spool.stage([(f, f"xet://user/repo/main/0/run{i}/artifacts/file.txt")], f"Log {i}")
+               for i, f in enumerate(files)]
+
+    spool.commit(batches[0])
+    # all pending batches went into a single transaction
+    assert(xet_client.XetFS.call_count == 1)
+    assert(fs.open.call_count == 3)
+    assert(not os.listdir(spool.pending_dir))
+
+    # batches committed by another writer are not committed again
+    spool.commit(batches[1])
+    assert(xet_client.XetFS.call_count == 1)
+
+def mock_spool_client(failing_dest=None):
+    # returns a mocked xet client and the {dest: content} written by each successful transaction
+    xet_client = mock.MagicMock()
+    fs = xet_client.XetFS.return_value
+    committed = []
+    writes = {}
+    def open_dest(dest_path, mode):
+        if dest_path == failing_dest:
+            raise OSError(f"cannot write {dest_path}")
+        dest_file = mock.MagicMock()
+        dest_file.write.side_effect = lambda data: writes.__setitem__(dest_path, data)
+        return dest_file
+    def enter(*args):
+        writes.clear()
+        return fs.transaction
+    def exit(*args):
+        if args[0] is None:
+            committed.append(dict(writes))
+        return False
+    fs.open.side_effect = open_dest
+    fs.transaction.__enter__.side_effect = enter
+    fs.transaction.__exit__.side_effect = exit
+    return xet_client, committed
+
+def stage_text(spool, tmp_path, dest_path, text):
+    local_file = tmp_path / f"{len(os.listdir(tmp_path))}.txt"
+    local_file.write_text(text)
+    return spool.stage([(str(local_file), dest_path)], f"Log {text}")
+
+def test_coordinated_commit_last_staged_wins(tmp_path):
+    xet_client, committed = mock_spool_client()
+    spool = CommitSpool(str(tmp_path / "spool"), "xet://user/repo/main", xet_client)
+    dest_path = "xet://user/repo/main/0/run/artifacts/file.txt"
+    first = stage_text(spool, tmp_path, dest_path, "first")
+    stage_text(spool, tmp_path, dest_path, "second")
+
+    spool.commit(first)
+    assert(committed == [{dest_path: b"second"}])
+    assert(not os.listdir(spool.pending_dir))
+
+def test_coordinated_commit_isolates_failing_batch(tmp_path):
+    bad_dest = "xet://user/repo/main/0/bad/artifacts/file.txt"
+    xet_client, committed = mock_spool_client(failing_dest=bad_dest)
+    spool = CommitSpool(str(tmp_path / "spool"), "xet://user/repo/main", xet_client)
+    good_dests = [f"xet://user/repo/main/0/run{i}/artifacts/file.txt" for i in range(MAX_BATCH_FAILURES)]
+
+    # a bad batch from a writer that never comes back to commit it
+    bad = stage_text(spool, tmp_path, bad_dest, "bad")
+    for i, dest_path in enumerate(good_dests):
+        spool.commit(stage_text(spool, tmp_path, dest_path, str(i)))
+        # the healthy batch still goes in, on its own
+        assert(committed[-1] == {dest_path: str(i).encode()})
+
+    assert(len(committed) == MAX_BATCH_FAILURES)
+    # after failing repeatedly the bad batch is set aside instead of blocking the spool
+    assert(not os.listdir(spool.pending_dir))
+    assert(os.listdir(spool.failed_dir) == [bad])
+    with pytest.raises(MlflowException):
+        spool.commit(bad)
+
+def test_coordinated_commit_drops_own_failing_batch(tmp_path):
+    bad_dest = "xet://user/repo/main/0/bad/artifacts/file.txt"
+    xet_client, committed = mock_spool_client(failing_dest=bad_dest)
+    spool = CommitSpool(str(tmp_path / "spool"), "xet://user/repo/main", xet_client)
+    good_dest = "xet://user/repo/main/0/run/artifacts/file.txt"
+    stage_text(spool, tmp_path, good_dest, "good")
+
+    with pytest.raises(OSError):
+        spool.commit(stage_text(spool, tmp_path, bad_dest, "bad"))
+    # the failing batch is dropped and the other one still goes in
+    assert(committed == [{good_dest: b"good"}])
+    assert(not os.listdir(spool.pending_dir))
+
+def test_coordinated_commit_keeps_healthy_waiting_batches(tmp_path):
+    bad_dest = "xet://user/repo/main/0/bad/artifacts/file.txt"
+    xet_client, committed = mock_spool_client(failing_dest=bad_dest)
+    spool = CommitSpool(str(tmp_path / "spool"), "xet://user/repo/main", xet_client)
+    waiting_dest = "xet://user/repo/main/0/waiting/artifacts/file.txt"
+    other_dests = [f"xet://user/repo/main/0/run{i}/artifacts/file.txt" for i in range(MAX_BATCH_FAILURES)]
+
+    bad = stage_text(spool, tmp_path, bad_dest, "bad")
+    # a healthy batch whose owner is still waiting for the lock
+    waiting = stage_text(spool, tmp_path, waiting_dest, "waiting")
+    for i, dest_path in enumerate(other_dests):
+        spool.commit(stage_text(spool, tmp_path, dest_path, str(i)))
+
+    # good batches were committed together, the first time around
+    assert(committed[0] == {waiting_dest: b"waiting", other_dests[0]: b"0"})
+    assert(os.listdir(spool.failed_dir) == [bad])
+    assert(not os.listdir(spool.pending_dir))
+    # the waiting owner finds its batch already committed
+    spool.commit(waiting)
+
+def test_coordinated_commit_no_strikes_when_everything_fails(tmp_path):
+    xet_client, committed = mock_spool_client()
+    xet_client.XetFS.return_value.open.side_effect = OSError("XetHub unavailable")
+    spool = CommitSpool(str(tmp_path / "spool"), "xet://user/repo/main", xet_client)
+    waiting = stage_text(spool, tmp_path, "xet://user/repo/main/0/waiting/artifacts/file.txt", "waiting")
+
+    for i in range(MAX_BATCH_FAILURES):
+        with pytest.raises(OSError):
+            spool.commit(stage_text(spool, tmp_path, f"xet://user/repo/main/0/run{i}/artifacts/file.txt", str(i)))
+    assert(os.listdir(spool.pending_dir) == [waiting])
+    assert(not os.listdir(spool.failed_dir))
+
+def test_coordinated_commit_stage_heartbeat(tmp_path, monkeypatch):
+    monkeypatch.setattr(commit_spool, "STAGING_HEARTBEAT_SECONDS", 0)
+    xet_client, committed = mock_spool_client()
+    spool = CommitSpool(str(tmp_path / "spool"), "xet://user/repo/main", xet_client)
+    with mock.patch.object(os, "utime", wraps=os.utime) as utime_mock:
+        stage_text(spool, tmp_path, "xet://user/repo/main/0/run/artifacts/file.txt", "large")
+    # the staging directory is kept fresh while its files are copied
+    assert(utime_mock.call_count)
+    assert(utime_mock.call_args[0][0].startswith(spool.staging_dir))
+
+def test_coordinated_commit_sweeps_stale_staging(tmp_path):
+    xet_client, committed = mock_spool_client()
+    spool = CommitSpool(str(tmp_path / "spool"), "xet://user/repo/main", xet_client)
+    stale = os.path.join(spool.staging_dir, "stale")
+    os.makedirs(stale)
+    old = os.path.getmtime(stale) - STALE_STAGING_SECONDS - 1
+    os.utime(stale, (old, old))
+
+    spool.commit(stage_text(spool, tmp_path, "xet://user/repo/main/0/run/artifacts/file.txt", "good"))
+    assert(not os.listdir(spool.staging_dir))
+
 def test_delete_artifacts(run):
     artifact_uri = run.info.artifact_uri
     repository = get_artifact_repository(artifact_uri)